@@ -1,10 +1,11 @@
 from dataclasses import dataclass
 from enum import Enum
+from functools import lru_cache
 from typing import Callable, Optional
 
 from term_fact_rule import And, ExprOrFact, Fact, Or, Rule, Term
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Location:
 	col: int = 0 
 	line: int = 0
@@ -19,23 +20,46 @@ class TokenType(Enum):
 	COLONDASH = "colon-dash"
 	SEMICOLON = "semicolon"
 
-	@staticmethod
-	def from_char(c: str) -> 'TokenType':
-		match c:
-			case '(': return TokenType.LPAREN
-			case ')': return TokenType.RPAREN
-			case '.': return TokenType.PERIOD
-			case ',': return TokenType.COMMA
-			case ';': return TokenType.SEMICOLON
-			case _: assert False, c
-
 	def __repr__(self) -> str:
 		return self._value_
 	
 	def __str__(self) -> str:
 		return repr(self)
+
+PUNCTUATION_TYPES: dict[int, TokenType] = {
+	ord('('): TokenType.LPAREN,
+	ord(')'): TokenType.RPAREN,
+	ord('.'): TokenType.PERIOD,
+	ord(','): TokenType.COMMA,
+	ord(';'): TokenType.SEMICOLON,
+}
+
+# Class of every byte of the (UTF-8 encoded) source, so the lexer needs a single lookup per ASCII character
+OTHER, WHITESPACE, IDENT_CHAR, PUNCTUATION, COLON, COMMENT, NON_ASCII = range(7)
+CHAR_CLASS = bytearray(256)
+for c in b' \t\n\r\v\f': CHAR_CLASS[c] = WHITESPACE
+for c in b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_': CHAR_CLASS[c] = IDENT_CHAR
+for c in range(0x80, 0x100): CHAR_CLASS[c] = NON_ASCII
+for c in PUNCTUATION_TYPES: CHAR_CLASS[c] = PUNCTUATION
+CHAR_CLASS[ord(':')] = COLON
+CHAR_CLASS[ord('%')] = COMMENT
+DASH, NEWLINE = b'-\n'
+
+def char_class_at(buf: bytes, position: int) -> tuple[int, int]:
+	"""
+	Get the class of the character starting at position, and its length in bytes.
+
+	Non-ASCII characters are decoded, and classed like the str methods do: as whitespace, letters or neither.
+	"""
+	c = buf[position]
+	if c < 0x80: return (CHAR_CLASS[c], 1)
+	width = 2 if c < 0xE0 else 3 if c < 0xF0 else 4
+	char = buf[position:position+width].decode(errors='replace')
+	if char.isspace(): return (WHITESPACE, width)
+	if char.isalpha(): return (IDENT_CHAR, width)
+	return (OTHER, width)
 	
-@dataclass
+@dataclass(slots=True, eq=False)
 class Token:
 	source: str
 	type: TokenType
@@ -47,6 +71,7 @@ class Token:
 class Lexer:
 	def __init__(self, source: str):
 		self.source = source
+		self.buf = source.encode()
 		self.position = 0
 		self.location: Location = Location(self.position, 0)
 		self.peeked: Optional[Token] = None
@@ -56,36 +81,48 @@ class Lexer:
 		with open(file_path, 'r') as f:
 			return Lexer(f.read())
 		
-	def advance(self) -> str:
-		# TODO: Actually advance the location
-		self.position += 1
-		return self.source[self.position] if self.position < len(self.source) else ''
-
 	def next_token(self) -> Token:
 		if self.peeked is not None:
 			token, self.peeked = self.peeked, None
 			return token
 		
-		while self.position < len(self.source) and self.source[self.position].isspace(): self.advance()
-		if self.position >= len(self.source): return Token('\0', TokenType.EOF, self.location)
-
-		match self.source[self.position]:
-			case c if c.isalpha() or c == '_':
-				start = self.position
-				start_location = self.location
-				while self.position < len(self.source) and (self.source[self.position].isalpha() or self.source[self.position] == '_'): self.advance()
-				ident = self.source[start:self.position]
-				return Token(ident, TokenType.IDENT, start_location)
-			case c if c in '().,;': 
-				location = self.location
-				self.advance()
-				return Token(c, TokenType.from_char(c), location)
-			case ':' if self.position < len(self.source)-1 and self.source[self.position+1] == '-':
-				location = self.location
-				self.advance()
-				self.advance()
-				return Token(':-', TokenType.COLONDASH, location)
-			case c: assert False, f"Unimplemented: '{c}'"
+		# TODO: Actually advance the location
+		buf, position, length = self.buf, self.position, len(self.buf)
+		while True:
+			while position < length and CHAR_CLASS[buf[position]] == WHITESPACE: position += 1
+			if position >= length: break
+			char_class = CHAR_CLASS[buf[position]]
+			if char_class == COMMENT:
+				# Comments run to the end of their line
+				comment_end = buf.find(NEWLINE, position)
+				position = length if comment_end == -1 else comment_end
+				continue
+			if char_class != NON_ASCII: break
+			(char_class, width) = char_class_at(buf, position)
+			if char_class != WHITESPACE: break
+			position += width
+		self.position = position
+		if position >= length: return Token('\0', TokenType.EOF, self.location)
+
+		if char_class == IDENT_CHAR:
+			start = position
+			while True:
+				while position < length and CHAR_CLASS[buf[position]] == IDENT_CHAR: position += 1
+				if position >= length or CHAR_CLASS[buf[position]] != NON_ASCII: break
+				(next_class, width) = char_class_at(buf, position)
+				if next_class != IDENT_CHAR: break
+				position += width
+			self.position = position
+			return Token(buf[start:position].decode(), TokenType.IDENT, self.location)
+		elif char_class == PUNCTUATION:
+			self.position = position+1
+			return Token(chr(buf[position]), PUNCTUATION_TYPES[buf[position]], self.location)
+		elif char_class == COLON and position+1 < length and buf[position+1] == DASH:
+			self.position = position+2
+			return Token(':-', TokenType.COLONDASH, self.location)
+		else:
+			(_, width) = char_class_at(buf, position)
+			assert False, f"Unimplemented: '{buf[position:position+width].decode(errors='replace')}'"
 
 	def peek_token(self) -> Token:
 		if self.peeked is not None: return self.peeked
@@ -133,27 +170,28 @@ def parse_primary(lexer: Lexer) -> ExprOrFact:
 	
 	return parse_fact(lexer)
 
-precedences: list[dict[TokenType, Callable[[ExprOrFact, ExprOrFact], ExprOrFact]]] = [
-	{TokenType.COMMA: And},
-	{TokenType.SEMICOLON: Or}
-]
-
-def parse_expression_at_level(lexer: Lexer, level: int) -> ExprOrFact:
-	if level >= len(precedences): return parse_primary(lexer)
-	left = parse_expression_at_level(lexer, level+1)
-	while (token := lexer.take_token(*list(precedences[level]))):
-		left = precedences[level][token.type](left, parse_expression_at_level(lexer, level+1))
+# Operators by how tightly they bind; all of them are left-associative
+precedences: dict[TokenType, tuple[int, Callable[[ExprOrFact, ExprOrFact], ExprOrFact]]] = {
+	TokenType.COMMA: (0, And),
+	TokenType.SEMICOLON: (1, Or),
+}
+
+def parse_fact_or_expr(lexer: Lexer, min_precedence: int=0) -> ExprOrFact:
+	left = parse_primary(lexer)
+	while (operator := precedences.get(lexer.peek_token().type)) and operator[0] >= min_precedence:
+		lexer.next_token()
+		precedence, make_expr = operator
+		left = make_expr(left, parse_fact_or_expr(lexer, precedence+1))
 	return left
 
-def parse_fact_or_expr(lexer: Lexer) -> ExprOrFact:
-	return parse_expression_at_level(lexer, 0)
-
 def parse_statement(lexer: Lexer) -> Fact | Rule:
+	"""Parse a statement up to and including its period, leaving the lexer at the next one."""
 	fact = parse_fact(lexer)
 	if lexer.take_token(TokenType.COLONDASH):
-		return Rule(fact, parse_fact_or_expr(lexer))
+		rule = Rule(fact, parse_fact_or_expr(lexer))
+		lexer.expect(TokenType.PERIOD)
+		return rule
 	lexer.expect(TokenType.PERIOD)
-	lexer.expect(TokenType.EOF)
 	assert not fact.is_variable, f"Unimplemented: variable facts/bodyless rules"
 	return fact
 
@@ -161,4 +199,9 @@ def parse_query(lexer: Lexer) -> ExprOrFact:
 	fact_or_expr = parse_fact_or_expr(lexer)
 	lexer.expect(TokenType.PERIOD)
 	lexer.expect(TokenType.EOF)
-	return fact_or_expr
\ No newline at end of file
+	return fact_or_expr
+
+# Terms are interned and parsed expressions are never modified, so parses of the same query can be shared
+@lru_cache(maxsize=1024)
+def parse_query_str(query_str: str) -> ExprOrFact:
+	return parse_query(Lexer(query_str))
@@ -1,35 +1,322 @@
-
 from itertools import product
 import sys
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional
 
-from parser import Lexer, parse_statement, parse_query
-from term_fact_rule import Expr, ExprOrFact, ExprType, Fact, Rule, Term, TermType, add_facts, add_rules
+from parser import Lexer, TokenType, parse_statement, parse_query_str
+from term_fact_rule import Expr, ExprOrFact, ExprType, Fact, Rule, Term, TermType, add_facts, add_rules, generation
 
 debug = False
 
-def matches(pattern: list[Term], terms: list[Term]) -> Optional[dict[str, Term]]:
-	var_dict: dict[str, Term] = {}
+# A goal is a rule applied to atoms and variables; variables are numbered by first occurrence
+# so that goals which only differ in variable names share their answers.
+Goal = tuple[Term, tuple[Term | int, ...]]
+Answer = tuple[Term, ...]
+# Whether an expression holds under some bindings, at some debug depth
+CompiledExpr = Callable[[dict[str, Term], int], bool]
+
+_answer_table: dict[Goal, list[Answer]] = {}
+# Generation of the knowledge base the tabled answers were derived from
+_table_generation = generation()
+# Goals currently being evaluated, with their position in the evaluation stack
+_in_progress: dict[Goal, int] = {}
+# The pass each goal in the evaluation stack is currently on; passes are numbered in the order they start
+_passes: list[int] = []
+_pass_count = 0
+# Position of the outermost in-progress goal the current evaluation has depended on
+_dependency = 0
+# Whether, during the current pass, a table grew after it had been read to its end, so another pass is needed
+_missed = False
+# The last pass in which each growing table was read to its end
+_read_to_end: dict[Goal, int] = {}
+# Goals whose tables are still growing, since they are in a cycle that is being evaluated, in the order
+# they were first reached: their known answers, the position of the outermost goal they depended on,
+# and the pass they were last evaluated in
+_partial: dict[Goal, tuple[set[Answer], int, int]] = {}
+
+def clear_table():
+	"""Forget every tabled answer; done by tabled() whenever the knowledge base has changed."""
+	global _table_generation
+	_answer_table.clear()
+	_partial.clear()
+	_read_to_end.clear()
+	_table_generation = generation()
+
+def tabled(goal: Goal, evaluate: Callable[[], Iterable[Answer]]) -> Iterable[Answer]:
+	"""
+	Get the answers of a goal, evaluating it only if they are not already tabled.
+
+	A goal that is reached again while it is still being evaluated gets its answers as they are found,
+	so recursion always terminates and every answer is passed on only once per pass. The outermost goal
+	of such a cycle runs passes over it until no table grows after having been read to its end, and the
+	goals inside the cycle keep their answers between passes; only then are they complete.
+	"""
+	global _dependency, _missed, _pass_count
+	if not _in_progress and _table_generation != generation(): clear_table()
+	position = _in_progress.get(goal)
+	if position is not None:
+		_dependency = min(_dependency, position)
+		return read_growing(goal, _answer_table[goal])
+	answers = _answer_table.get(goal)
+	partial = _partial.get(goal)
+	if answers is not None:
+		if partial is None: return answers
+		(known_answers, dependency, evaluated_in) = partial
+		if dependency < len(_passes) and _passes[dependency] <= evaluated_in:
+			# Already evaluated in this pass over its cycle
+			_dependency = min(_dependency, dependency)
+			return read_growing(goal, answers)
+	else:
+		answers = _answer_table[goal] = []
+		known_answers = set()
+	# Goals first reached from here on are in this goal's cycle, if any
+	partial_count = len(_partial) - (partial is not None)
+
+	position = len(_in_progress)
+	_in_progress[goal] = position
+	_passes.append(0)
+	outer_dependency, outer_missed = _dependency, _missed
+	finished = False
+	try:
+		while True:
+			_pass_count += 1
+			current_pass = _passes[position] = _pass_count
+			_dependency, _missed = position + 1, False
+			for answer in evaluate():
+				if answer in known_answers: continue
+				known_answers.add(answer)
+				answers.append(answer)
+				if _read_to_end.get(goal, -1) >= _passes[0]: _missed = True
+			if _dependency != position or not _missed: break
+		finished = True
+	finally:
+		dependency, missed = _dependency, _missed
+		del _in_progress[goal]
+		_passes.pop()
+		_dependency, _missed = outer_dependency, outer_missed
+		if not finished:
+			# Also leave the tables consistent if the evaluation raised
+			_answer_table.pop(goal, None)
+			for partial_goal in _partial: _answer_table.pop(partial_goal, None)
+			_partial.clear()
+
+	if dependency < position:
+		# Inside the cycle of an outer goal, which has to run another pass if this one missed anything
+		_partial[goal] = (known_answers, dependency, current_pass)
+		_dependency = min(outer_dependency, dependency)
+		_missed = outer_missed or missed
+		return read_growing(goal, answers)
+	# The cycle is complete, apart from the goals the last pass did not reach, whose answers may be stale
+	_partial.pop(goal, None)
+	_read_to_end.pop(goal, None)
+	while len(_partial) > partial_count:
+		(partial_goal, (_, _, evaluated_in)) = _partial.popitem()
+		_read_to_end.pop(partial_goal, None)
+		if evaluated_in < current_pass: del _answer_table[partial_goal]
+	return answers
+
+def read_growing(goal: Goal, answers: list[Answer]) -> Iterator[Answer]:
+	"""Read the table of a goal that is still being evaluated, including the answers added meanwhile."""
+	i = 0
+	while i < len(answers):
+		yield answers[i]
+		i += 1
+	_read_to_end[goal] = _pass_count
+
+def make_goal(rule: Term, arguments: list[Term]) -> Goal:
+	variables: dict[str, int] = {}
+	return (rule, tuple(variables.setdefault(term.name, len(variables)) if term.type == TermType.Var else term for term in arguments))
+
+# Bindings of a query without variables; shared, so must never be modified
+_EMPTY_DICT: dict[str, Term] = {}
+
+def unify(pattern: list[Term], terms: list[Term], bindings: dict[str, Term]) -> Optional[dict[str, Term]]:
+	"""
+	Unify the variables of pattern with the atoms of terms, on top of the existing bindings.
+
+	Variables in terms are left unconstrained. Returns the extended bindings, or None if they clash.
+	"""
 	if len(pattern) != len(terms): return None
+	new_bindings = bindings
 	for (pattern_term, term) in zip(pattern, terms):
-		assert pattern_term.name not in var_dict, f"Not implemented: proper pattern matching, {pattern}"
-		var_dict[pattern_term.name] = term
-	return var_dict
+		if term.type == TermType.Var: continue
+		if pattern_term.type == TermType.Var:
+			bound = new_bindings.get(pattern_term.name)
+			if bound is None:
+				if new_bindings is bindings: new_bindings = dict(bindings)
+				new_bindings[pattern_term.name] = term
+			elif bound is not term: return None
+		elif pattern_term is not term: return None
+	return new_bindings
+
+def argument_matcher(pattern: list[Term]) -> Callable[[list[Term]], bool]:
+	"""
+	Specialise unifying pattern with lists of atoms into a check of only the positions that constrain it:
+	the atoms of pattern, and the positions sharing a variable.
+	"""
+	atom_positions = [(i, term) for (i, term) in enumerate(pattern) if term.type == TermType.Atom]
+	first_positions: dict[str, int] = {}
+	shared_positions: list[tuple[int, int]] = []
+	for (i, term) in enumerate(pattern):
+		if term.type != TermType.Var: continue
+		if term.name in first_positions: shared_positions.append((first_positions[term.name], i))
+		else: first_positions[term.name] = i
+	arity = len(pattern)
+	return lambda terms: (len(terms) == arity
+		and all(terms[i] is atom for (i, atom) in atom_positions)
+		and all(terms[i] is terms[j] for (i, j) in shared_positions))
+
+def head_binder(pattern: list[Term]) -> Callable[[list[Term]], Optional[dict[str, Term]]]:
+	"""
+	Specialise unifying a rule head with the atoms of ground goals.
+
+	A head of distinct variables, the usual case, only needs the arity checked, and small ones build
+	their bindings directly; any other head is unified in full.
+	"""
+	names = [term.name for term in pattern]
+	arity = len(pattern)
+	if any(term.type != TermType.Var for term in pattern) or len(set(names)) != arity:
+		return lambda terms: unify(pattern, terms, _EMPTY_DICT)
+	match names:
+		case []: return lambda terms: None if terms else _EMPTY_DICT
+		case [a]: return lambda terms: {a: terms[0]} if len(terms) == 1 else None
+		case [a, b]: return lambda terms: {a: terms[0], b: terms[1]} if len(terms) == 2 else None
+		case [a, b, c]: return lambda terms: {a: terms[0], b: terms[1], c: terms[2]} if len(terms) == 3 else None
+		case _: return lambda terms: dict(zip(names, terms)) if len(terms) == arity else None
+
+def with_free_variables(bindings: dict[str, Term], variables: Iterable[str]) -> Iterator[dict[str, Term]]:
+	"""Extend the bindings with every assignment of atoms to the variables they leave unbound."""
+	free_variables = [var for var in variables if var not in bindings]
+	if not free_variables:
+		yield bindings
+		return
+	for atoms in product(Term.all_terms[TermType.Atom].values(), repeat=len(free_variables)):
+		yield bindings | dict(zip(free_variables, atoms))
 
-def query_simple(fact: ExprOrFact, depth:int=0) -> bool:
+def query_simple(fact: ExprOrFact, bindings: Optional[dict[str, Term]]=None, depth:int=0) -> bool:
+	"""Check whether an expression holds, looking its variables up in bindings."""
 	if debug: print(f"{chr(9)*depth}Querying simple... {fact}")
-	assert not fact.is_variable, "Cannot do a simple query on a variable expression"
+	if bindings is None: bindings = _EMPTY_DICT
+	assert fact.get_variables().issubset(bindings), "Cannot do a simple query on a variable expression"
 	if isinstance(fact, Fact):
-		for rule in Rule.all_rules:
-			if rule.fact.rule == fact.rule:
-				vars_dict = matches(rule.fact.arguments, fact.arguments)
-				if vars_dict is None: continue
-				if query(rule.body.replace(vars_dict), depth+1, False): return True
-		return fact in Fact.all_facts
+		arguments = resolve(fact.arguments, bindings) if fact.is_variable else fact.arguments
+		return next(iter(tabled((fact.rule, tuple(arguments)), lambda: prove_simple(fact.rule, arguments, depth))), None) is not None
 	elif isinstance(fact, Expr):
 		match fact.type:
-			case ExprType.And: return query_simple(fact.arg1, depth+1) and query_simple(fact.arg2, depth+1)
-			case ExprType.Or: return query_simple(fact.arg1, depth+1) or query_simple(fact.arg2, depth+1)
+			case ExprType.And:
+				for conjunct in sorted(fact.flatten(ExprType.And), key=lambda conjunct: estimated_cost(conjunct, bindings)):
+					if not query_simple(conjunct, bindings, depth+1): return False
+				return True
+			case ExprType.Or:
+				for disjunct in fact.flatten(ExprType.Or):
+					if query_simple(disjunct, bindings, depth+1): return True
+				return False
+			case _: assert False, f"Unimplemented: {fact.type}"
+	else:
+		assert False, f"Unimplemented: {fact}"
+
+def resolve(terms: list[Term], bindings: dict[str, Term]) -> list[Term]:
+	return [bindings.get(term.name, term) if term.type == TermType.Var else term for term in terms]
+
+def estimated_cost(fact: ExprOrFact, bindings: dict[str, Term]) -> tuple[int, int]:
+	"""
+	Rough cost of a simple query, so that cheap goals of a conjunction can fail it before expensive ones run.
+
+	Goals that need rules cost more than those only looked up among the facts, and the fewer facts can
+	match a goal, the more likely it is to fail.
+	"""
+	if isinstance(fact, Expr): return (sys.maxsize, 0)
+	by_first_argument = Fact.all_facts_by_rule.get(fact.rule, {})
+	first_argument = fact.first_argument
+	if first_argument is not None and first_argument.type == TermType.Var: first_argument = bindings.get(first_argument.name)
+	if first_argument is None and fact.arguments: fact_count = sum(map(len, by_first_argument.values()))
+	else: fact_count = len(by_first_argument.get(first_argument, ()))
+	return (len(Rule.all_rules_by_rule.get(fact.rule, ())), fact_count)
+
+def prove_simple(rule_term: Term, arguments: list[Term], depth: int) -> Iterator[Answer]:
+	answer = tuple(arguments)
+	if (rule_term, answer) in Fact._all_keys:
+		yield answer
+		return
+	for rule in Rule.all_rules_by_rule.get(rule_term, ()):
+		# The body gets its own frame of bindings, since its variables are unrelated to the caller's
+		if rule._bind_head is None: rule._bind_head = head_binder(rule.fact.arguments)
+		vars_dict = rule._bind_head(arguments)
+		if vars_dict is None: continue
+		if rule._compiled is None: rule._compiled = compile_expr(rule.body, rule.fact.get_variables())
+		if rule._compiled(vars_dict, depth+1):
+			yield answer
+			return
+
+def prove_variable(fact: Fact, depth: int) -> Iterator[Answer]:
+	by_first_argument = Fact.all_facts_by_rule.get(fact.rule, {})
+	first_argument = fact.first_argument
+	if first_argument is None or first_argument.type == TermType.Var:
+		candidates = [other for others in by_first_argument.values() for other in others]
+	else:
+		candidates = by_first_argument.get(first_argument, [])
+	matches_goal = argument_matcher(fact.arguments)
+	for other in candidates:
+		if matches_goal(other.arguments): yield tuple(other.arguments)
+
+	for rule in Rule.all_rules_by_rule.get(fact.rule, ()):
+		head_bindings = unify(rule.fact.arguments, fact.arguments, {})
+		if head_bindings is None: continue
+		for body_bindings in solve(rule.body, head_bindings, depth+1):
+			for bindings in with_free_variables(body_bindings, rule.fact.get_variables()):
+				answer = [term if term.type == TermType.Atom else bindings.get(head_term.name, head_term) for (head_term, term) in zip(rule.fact.arguments, fact.arguments)]
+				if unify(fact.arguments, answer, {}) is not None: yield tuple(answer)
+
+def compile_expr(fact: ExprOrFact, bound_variables: frozenset[str]) -> CompiledExpr:
+	"""
+	Specialise an expression into a function checking whether it holds, given bindings for bound_variables.
+
+	Disjunctions are evaluated directly, and so are conjunctions, cheapest conjuncts first, unless a
+	variable they do not bind links two conjuncts, in which case they have to be solved at once.
+	"""
+	free_variables = fact.get_variables() - bound_variables
+	if not free_variables and isinstance(fact, Fact):
+		return lambda bindings, depth: query_simple(fact, bindings, depth)
+	if isinstance(fact, Expr):
+		match fact.type:
+			case ExprType.And:
+				conjuncts = fact.flatten(ExprType.And)
+				seen_free_variables: set[str] = set()
+				for conjunct in conjuncts:
+					conjunct_free_variables = conjunct.get_variables() - bound_variables
+					if not seen_free_variables.isdisjoint(conjunct_free_variables): break
+					seen_free_variables |= conjunct_free_variables
+				else:
+					compiled_conjuncts = [(conjunct, compile_expr(conjunct, bound_variables)) for conjunct in conjuncts]
+					def holds_and(bindings: dict[str, Term], depth: int) -> bool:
+						for (_, compiled) in sorted(compiled_conjuncts, key=lambda pair: estimated_cost(pair[0], bindings)):
+							if not compiled(bindings, depth+1): return False
+						return True
+					return holds_and
+			case ExprType.Or:
+				left, right = compile_expr(fact.arg1, bound_variables), compile_expr(fact.arg2, bound_variables)
+				return lambda bindings, depth: left(bindings, depth+1) or right(bindings, depth+1)
+			case _: assert False, f"Unimplemented: {fact.type}"
+	return lambda bindings, depth: next(solve(fact, bindings, depth), None) is not None
+
+def solve(fact: ExprOrFact, bindings: dict[str, Term], depth: int=0) -> Iterator[dict[str, Term]]:
+	"""Find every extension of the bindings under which the expression holds."""
+	if debug: print(f"{chr(9)*depth}Solving... {fact} with {bindings}")
+	if isinstance(fact, Fact):
+		if fact.get_variables().issubset(bindings):
+			if query_simple(fact, bindings, depth): yield bindings
+			return
+		goal = fact.replace(bindings)
+		for answer in tabled(make_goal(goal.rule, goal.arguments), lambda: prove_variable(goal, depth)):
+			new_bindings = unify(fact.arguments, list(answer), bindings)
+			if new_bindings is not None: yield new_bindings
+	elif isinstance(fact, Expr):
+		match fact.type:
+			case ExprType.And:
+				for left_bindings in solve(fact.arg1, bindings, depth+1):
+					yield from solve(fact.arg2, left_bindings, depth+1)
+			case ExprType.Or:
+				yield from solve(fact.arg1, bindings, depth+1)
+				yield from solve(fact.arg2, bindings, depth+1)
 			case _: assert False, f"Unimplemented: {fact.type}"
 	else:
 		assert False, f"Unimplemented: {fact}"
@@ -38,19 +325,22 @@ def query_variable(fact: ExprOrFact, depth:int=0, needs_all_answers: bool=True)
 	if debug: print(f"{chr(9)*depth}Querying variable... {fact}")
 	assert fact.is_variable, "Cannot do a variable query on a simple expression"
 	all_var_dicts: list[dict[str, Term]] = []
-	variables = fact.get_variables()
-	for atoms in product(Term.all_terms[TermType.Atom], repeat=len(variables)):
-		var_dict = {var: Term.all_terms[TermType.Atom][atoms[i]] for (i, var) in enumerate(variables)}
-		if query_simple(fact.replace(var_dict), depth+1):
-			all_var_dicts.append(var_dict)
-			if not needs_all_answers: break
+	seen_answers: set[Answer] = set()
+	variables = list(fact.get_variables())
+	for bindings in solve(fact, {}, depth+1):
+		for var_dict in with_free_variables(bindings, variables):
+			answer = tuple(var_dict[var] for var in variables)
+			if answer in seen_answers: continue
+			seen_answers.add(answer)
+			all_var_dicts.append({var: var_dict[var] for var in variables})
+			if not needs_all_answers: return all_var_dicts
 	return all_var_dicts
 
 def query(fact: ExprOrFact, depth: int=0, needs_all_var_answers:bool=True) -> bool | list[dict[str, Term]]:
 	if fact.is_variable:
 		return query_variable(fact, depth, needs_all_var_answers)
 	else:
-		return query_simple(fact, depth)
+		return query_simple(fact, depth=depth)
 	
 def print_query(result: bool | list[dict[str, Term]]):
 	if isinstance(result, bool): print({True: "yes", False: "no"}[result])
@@ -66,24 +356,23 @@ def print_query(result: bool | list[dict[str, Term]]):
 def handle_query(query_str: str):
 	query_str, *_ = query_str.strip().split("%")
 	if not query_str: return
-	lexer = Lexer(query_str)
-	fact_or_expr = parse_query(lexer)
+	fact_or_expr = parse_query_str(query_str)
 	print_query(query(fact_or_expr))
 
-def handle_statement(statement: str):
-	statement, *_ = statement.strip().split("%")
-	if not statement: return
-	lexer = Lexer(statement)
-	fact_or_rule = parse_statement(lexer)
-
+def add_statement(fact_or_rule: Fact | Rule):
 	if isinstance(fact_or_rule, Fact): add_facts(fact_or_rule)
 	elif isinstance(fact_or_rule, Rule): add_rules(fact_or_rule)
 	else: assert False, f"Unimplemented: {fact_or_rule}"
 
+def load_source(source: str):
+	"""Add every statement of source, all parsed by the same Lexer."""
+	lexer = Lexer(source)
+	while not lexer.check_token(TokenType.EOF):
+		add_statement(parse_statement(lexer))
+
 def load_file(path: str):
 	with open(path, 'r') as f:
-		for line in f.readlines():
-			handle_statement(line)
+		load_source(f.read())
 
 def handle_command(command: list[str]):
 	match command:
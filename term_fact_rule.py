@@ -1,7 +1,6 @@
-from abc import ABC
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import ClassVar, List
+from typing import Callable, ClassVar, List, Optional
 
 
 class TermType(Enum):
@@ -13,7 +12,8 @@ class TermType(Enum):
 		return self._value_
 
 class Term:
-	all_terms: 'dict[TermType, dict[str, Term]]' = {type: {} for type in TermType}
+	__slots__ = ('name', 'type')
+	all_terms: ClassVar['dict[TermType, dict[str, Term]]'] = {type: {} for type in TermType}
 
 	def __init__(self, name: str, type: TermType):
 		self.name = name
@@ -26,8 +26,8 @@ class Term:
 
 	@staticmethod
 	def _term(name: str, type: TermType) -> 'Term':
-		for term_name in Term.all_terms[type]:
-			if name == term_name: return Term.all_terms[type][name]
+		existing = Term.all_terms[type].get(name)
+		if existing is not None: return existing
 		return Term(name, type)
 
 	@staticmethod
@@ -52,10 +52,6 @@ class Term:
 	def __repr__(self) -> str:
 		return self.name
 	
-	def __eq__(self, value) -> bool:
-		if not isinstance(value, Term): return False
-		return self.name == value.name
-	
 	@staticmethod
 	def print_all():
 		for type in Term.all_terms:
@@ -74,16 +70,17 @@ class ExprType(Enum):
 			case _:
 				assert False, f"Not implemented: {self._name_}"
 
-@dataclass
-class Expr(ABC):
+@dataclass(slots=True, eq=False)
+class Expr:
 	arg1: 'ExprOrFact'
 	arg2: 'ExprOrFact'
 	type: ExprType
 	is_variable: bool = field(init=False, default=False)
+	_variables: frozenset[str] = field(init=False, default=frozenset(), repr=False, compare=False)
 
 	def __post_init__(self):
-		for arg in [self.arg1, self.arg2]:
-			if arg.is_variable: self.is_variable = True
+		self._variables = self.arg1._variables | self.arg2._variables
+		self.is_variable = bool(self._variables)
 
 	@staticmethod
 	def And(*args: 'ExprOrFact') -> 'ExprOrFact':
@@ -101,10 +98,28 @@ class Expr(ABC):
 		return f"({self.arg1}{self.type.op()} {self.arg2})"
 	
 	def replace(self, var_dict: dict[str, Term]) -> 'Expr':
-		return Expr(self.arg1.replace(var_dict), self.arg2.replace(var_dict), self.type)
+		# Subtrees without any of the replaced variables are shared rather than copied
+		if self._variables.isdisjoint(var_dict): return self
+		arg1, arg2 = self.arg1.replace(var_dict), self.arg2.replace(var_dict)
+		if arg1 is self.arg1 and arg2 is self.arg2: return self
+		return Expr(arg1, arg2, self.type)
 	
-	def get_variables(self) -> set[str]:
-		return self.arg1.get_variables() | self.arg2.get_variables()
+	def get_variables(self) -> frozenset[str]:
+		return self._variables
+
+	def flatten(self, type: ExprType) -> List['ExprOrFact']:
+		"""Get the operands of the nested expressions of the given type, in order."""
+		operands: List[ExprOrFact] = []
+		pending: List[ExprOrFact] = [self]
+		while pending:
+			expr = pending.pop()
+			if isinstance(expr, Expr) and expr.type == type: pending += [expr.arg2, expr.arg1]
+			else: operands.append(expr)
+		return operands
+
+	@property
+	def key(self) -> tuple:
+		return (self.type, self.arg1.key, self.arg2.key)
 	
 	def __and__(self, other: 'ExprOrFact') -> 'ExprOrFact':
 		return And(self, other)
@@ -112,52 +127,74 @@ class Expr(ABC):
 	def __or__(self, other: 'ExprOrFact') -> 'ExprOrFact':
 		return Or(self, other)
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Rule:
 	fact: 'Fact'
 	body: 'ExprOrFact'
+	# The body specialised into a check under bindings of the head's variables, built on first use
+	_compiled: Optional[Callable[[dict[str, Term], int], bool]] = field(init=False, default=None, repr=False, compare=False)
+	# Binds the head's variables to the atoms of a ground goal, or gives None if they do not unify; built on first use
+	_bind_head: Optional[Callable[[List[Term]], Optional[dict[str, Term]]]] = field(init=False, default=None, repr=False, compare=False)
 	adding: ClassVar[bool] = False
 
-	all_rules: 'ClassVar[List[Rule]]' = []
+	all_rules_by_rule: ClassVar['dict[Term, List[Rule]]'] = {}
+	_all_keys: ClassVar[set[tuple]] = set()
 
 	def __post_init__(self):
 		assert self.fact.is_variable
 		assert self.body.is_variable
-		if self.adding: self.all_rules.append(self)
+		if self.adding: add_rules(self)
 
 	@classmethod
 	def print_all(cls):
-		[print(rule) for rule in cls.all_rules]
+		[print(rule) for rules in cls.all_rules_by_rule.values() for rule in rules]
 
 	def __repr__(self) -> str:
 		return f"{self.fact} :- {self.body}"
 
-@dataclass
+	@property
+	def key(self) -> tuple:
+		return (self.fact.key, self.body.key)
+
+@dataclass(slots=True, eq=False)
 class Fact:
 	adding: ClassVar[bool] = False
 	rule: Term
 	arguments: List[Term]
 	is_variable: bool = field(init=False, default=False)
+	_variables: frozenset[str] = field(init=False, default=frozenset(), repr=False, compare=False)
 
-	all_facts: 'ClassVar[List[Fact]]' = []
+	# Indexed by rule, then by first argument (None for facts without arguments)
+	all_facts_by_rule: ClassVar['dict[Term, dict[Optional[Term], List[Fact]]]'] = {}
+	_all_keys: ClassVar[set[tuple]] = set()
 
 	def __post_init__(self):
 		assert self.rule.type == TermType.Rule
 		for argument in self.arguments:
 			assert argument.type == TermType.Var or argument.type == TermType.Atom
-			if argument.type == TermType.Var: self.is_variable = True
-		if self.adding and not self.is_variable:
-			self.all_facts.append(self)
+		self._variables = frozenset(argument.name for argument in self.arguments if argument.type == TermType.Var)
+		self.is_variable = bool(self._variables)
+		if self.adding and not self.is_variable: add_facts(self)
+
+	@property
+	def first_argument(self) -> Optional[Term]:
+		return self.arguments[0] if self.arguments else None
+
+	@property
+	def key(self) -> tuple:
+		"""Hashable form of the fact, equal for equal facts."""
+		return (self.rule, tuple(self.arguments))
 
 	def __repr__(self) -> str:
 		return f"{self.rule}({', '.join(map(str, self.arguments))})"
 	
 	def replace(self, var_dict: dict[str, Term]) -> 'Fact':
+		if self._variables.isdisjoint(var_dict): return self
 		return Fact(self.rule, [var_dict.get(term.name, term) if term.type == TermType.Var else term for term in self.arguments])
 		assert False, self
 
-	def get_variables(self) -> set[str]:
-		return {term.name for term in self.arguments if term.type == TermType.Var}
+	def get_variables(self) -> frozenset[str]:
+		return self._variables
 	
 	def __eq__(self, value) -> bool:
 		if not isinstance(value, Fact): return False
@@ -171,7 +208,7 @@ class Fact:
 	
 	@classmethod
 	def print_all(cls):
-		[print(fact) for fact in cls.all_facts]
+		[print(fact) for by_argument in cls.all_facts_by_rule.values() for facts in by_argument.values() for fact in facts]
 		
 class AddingFacts:
 	def __enter__(self):
@@ -189,16 +226,30 @@ class AddingRules:
 	def __exit__(self, *_):
 		Rule.adding = self.old_adding
 
+# Bumped whenever a new fact or rule is added, so answers derived from the old knowledge base can be dropped
+_generation = 0
+
+def generation() -> int:
+	return _generation
+
 def add_facts(*facts: Fact):
+	global _generation
 	for fact in facts:
 		assert not fact.is_variable, "Cannot have variable facts"
-		if fact not in Fact.all_facts:
-			Fact.all_facts.append(fact)
+		key = fact.key
+		if key in Fact._all_keys: continue
+		Fact._all_keys.add(key)
+		_generation += 1
+		Fact.all_facts_by_rule.setdefault(fact.rule, {}).setdefault(fact.first_argument, []).append(fact)
 
 def add_rules(*rules: Rule):
+	global _generation
 	for rule in rules:
-		if rule not in Rule.all_rules:
-			Rule.all_rules.append(rule)
+		key = rule.key
+		if key in Rule._all_keys: continue
+		Rule._all_keys.add(key)
+		_generation += 1
+		Rule.all_rules_by_rule.setdefault(rule.fact.rule, []).append(rule)
 
 ExprOrFact = Expr | Fact
 And = Expr.And
@@ -0,0 +1,261 @@
+import unittest
+from itertools import product
+
+import prolog
+from parser import Lexer, TokenType, parse_query_str, parse_statement
+from term_fact_rule import Fact, Rule, Term, add_facts
+
+NODES = ['na', 'nb', 'nc', 'nd', 'ne']
+# Contains a cycle (na -> nb -> nc -> na), a self loop (ne) and a sink (nd)
+EDGES = [('na', 'nb'), ('nb', 'nc'), ('nc', 'na'), ('nc', 'nd'), ('ne', 'ne')]
+
+RECURSIVE_PATHS = {
+	'right': ["rpath(X, Y) :- edge(X, Y).", "rpath(X, Y) :- edge(X, Z), rpath(Z, Y)."],
+	'left': ["lpath(X, Y) :- lpath(X, Z), edge(Z, Y).", "lpath(X, Y) :- edge(X, Y)."],
+	'double': ["dpath(X, Y) :- edge(X, Y).", "dpath(X, Y) :- dpath(X, Z), dpath(Z, Y)."],
+}
+
+def reset():
+	Fact.all_facts_by_rule.clear()
+	Fact._all_keys.clear()
+	Rule.all_rules_by_rule.clear()
+	Rule._all_keys.clear()
+	prolog.clear_table()
+
+def load(*statements: str):
+	prolog.load_source("\n".join(statements))
+
+def ask(query_str: str) -> bool | set[tuple[str, ...]]:
+	"""Answer a query as a bool, or as the set of tuples of its variables' values, sorted by variable name."""
+	result = prolog.query(parse_query_str(query_str))
+	if isinstance(result, bool): return result
+	return {tuple(str(var_dict[var]) for var in sorted(var_dict)) for var_dict in result}
+
+def transitive_closure(edges: list[tuple[str, str]]) -> set[tuple[str, str]]:
+	closure = set(edges)
+	while True:
+		new_pairs = {(a, d) for (a, b) in closure for (c, d) in closure if b == c} - closure
+		if not new_pairs: return closure
+		closure |= new_pairs
+
+class TestRecursion(unittest.TestCase):
+	def setUp(self):
+		reset()
+		load(*(f"edge({a}, {b})." for (a, b) in EDGES))
+
+	def test_recursive_paths_on_cyclic_graph(self):
+		closure = transitive_closure(EDGES)
+		for (kind, rules) in RECURSIVE_PATHS.items():
+			name = rules[0].split('(')[0]
+			with self.subTest(kind=kind):
+				load(*rules)
+				self.assertEqual(ask(f"{name}(X, Y)."), closure)
+				self.assertEqual(ask(f"{name}(na, Y)."), {(b,) for (a, b) in closure if a == 'na'})
+				self.assertEqual(ask(f"{name}(X, nd)."), {(a,) for (a, b) in closure if b == 'nd'})
+				for (a, b) in product(NODES, repeat=2):
+					self.assertEqual(ask(f"{name}({a}, {b})."), (a, b) in closure, (a, b))
+
+def walks(edges: list[tuple[str, str]], modulus: int) -> list[set[tuple[str, str]]]:
+	"""Pairs of nodes joined by a walk of at least one edge, by the walk's length modulo modulus."""
+	by_length: list[set[tuple[str, str]]] = [set() for _ in range(modulus)]
+	by_length[1 % modulus] |= set(edges)
+	while True:
+		extended = [{(a, d) for (a, b) in by_length[length-1] for (c, d) in edges if b == c} for length in range(modulus)]
+		if all(pairs <= known for (pairs, known) in zip(extended, by_length)): return by_length
+		for (known, pairs) in zip(by_length, extended): known |= pairs
+
+class TestGroundAndVariableQueries(unittest.TestCase):
+	def setUp(self):
+		reset()
+
+	def assert_agree(self, name: str, atoms: list[str]):
+		"""Every ground query must succeed exactly when the variable query lists it as an answer."""
+		answers = ask(f"{name}(A, B).")
+		assert isinstance(answers, set)
+		for (a, b) in product(atoms, repeat=2):
+			self.assertEqual(ask(f"{name}({a}, {b})."), (a, b) in answers, (a, b))
+
+	def test_atoms_in_rule_heads(self):
+		load("parent(bob, ann).", "headatom(a, X) :- parent(X, ann).")
+		self.assertEqual(ask("headatom(Y, bob)."), {('a',)})
+		self.assertFalse(ask("headatom(b, bob)."))
+		self.assert_agree('headatom', ['a', 'b', 'bob', 'ann'])
+
+	def test_repeated_variables_in_rule_heads(self):
+		load("edge(a, b).", "edge(b, b).", "same(X, X) :- edge(X, Y).")
+		self.assertEqual(ask("same(A, B)."), {('a', 'a'), ('b', 'b')})
+		self.assert_agree('same', ['a', 'b'])
+
+	def test_cycles_through_several_predicates(self):
+		# Walks around the odd cycle of EDGES have every parity, so odd and even walk an even cycle instead
+		links = [('na', 'nb'), ('nb', 'nc'), ('nc', 'nd'), ('nd', 'na'), ('nd', 'ne')]
+		load(*(f"edge({a}, {b})." for (a, b) in EDGES), *(f"link({a}, {b})." for (a, b) in links),
+			"odd(X, Y) :- link(X, Y).", "odd(X, Y) :- even(X, Z), link(Z, Y).", "even(X, Y) :- odd(X, Z), link(Z, Y).",
+			"one(X, Y) :- edge(X, Y).", "one(X, Y) :- three(X, Z), edge(Z, Y).",
+			"two(X, Y) :- one(X, Z), edge(Z, Y).", "three(X, Y) :- edge(X, Z), two(Z, Y).")
+		(even, odd) = walks(links, 2)
+		(three, one, two) = walks(EDGES, 3)
+		for (name, expected) in [('odd', odd), ('even', even), ('one', one), ('two', two), ('three', three)]:
+			with self.subTest(name=name):
+				self.assertEqual(ask(f"{name}(A, B)."), expected)
+				self.assert_agree(name, NODES)
+
+	def test_rule_heads_of_other_arities(self):
+		load("edge(a, b).", "linked(X) :- edge(X, Y).", "linked(X, Y) :- edge(X, Y).", "linked(X, Y, Z) :- edge(X, Y), edge(Y, Z).")
+		self.assertTrue(ask("linked(a)."))
+		self.assertFalse(ask("linked(b)."))
+		self.assertFalse(ask("linked(a, b, b)."))
+		self.assert_agree('linked', ['a', 'b'])
+
+class TestTable(unittest.TestCase):
+	def setUp(self):
+		reset()
+
+	def test_added_facts_invalidate_answers(self):
+		load("link(a, b).", "reach(X, Y) :- link(X, Y).")
+		self.assertFalse(ask("reach(a, c)."))
+		add_facts(Term.rule('link')(Term.atom('a'), Term.atom('c')))
+		self.assertTrue(ask("link(a, c)."))
+		self.assertTrue(ask("reach(a, c)."))
+		self.assertEqual(ask("reach(a, Y)."), {('b',), ('c',)})
+
+	def test_failed_evaluation_is_not_tabled(self):
+		load("base(a).", "top(X) :- base(X).")
+		prove_simple = prolog.prove_simple
+		def failing_prove_simple(rule: Term, arguments: list[Term], depth: int):
+			if rule.name == 'base': raise RuntimeError("failing evaluation")
+			return prove_simple(rule, arguments, depth)
+
+		prolog.prove_simple = failing_prove_simple
+		try:
+			with self.assertRaises(RuntimeError): ask("top(a).")
+		finally:
+			prolog.prove_simple = prove_simple
+		self.assertEqual(prolog._in_progress, {})
+		self.assertTrue(ask("top(a)."))
+
+	def test_goals_inside_a_cycle_are_complete(self):
+		# walked is only reached inside the cycle of reached, through the last rule
+		load("start(na).", "step(na, nb).", "step(nb, nc).", "step(nc, nd).", "never(zz).",
+			"reached(X) :- walked(X).", "walked(X) :- start(X).", "walked(X) :- walked(Y), step(Y, X).",
+			"walked(X) :- reached(X), never(X).")
+		self.assertEqual(ask("reached(X)."), {('na',), ('nb',), ('nc',), ('nd',)})
+		self.assertTrue(ask("reached(nd)."))
+		self.assertEqual(ask("walked(X)."), {('na',), ('nb',), ('nc',), ('nd',)})
+
+	def test_answers_do_not_depend_on_query_order(self):
+		# ka is only reached through the domain closure of spread
+		program = ("arc(kb, kd).", "other(ka).", "twin(Z, Z) :- arc(X, Z).", "twin(X, Y) :- marked(Z), twin(Y, X).",
+			"spread(X) :- spread(Y).", "spread(Y) :- twin(Y, kd).", "marked(X) :- spread(X).")
+		load(*program)
+		fresh = ask("marked(X).")
+		reset()
+		load(*program)
+		self.assertTrue(ask("spread(ka)."))
+		self.assertEqual(ask("marked(X)."), fresh)
+		self.assertIn(('ka',), fresh)
+
+	def test_left_recursion_reads_its_own_answers_as_they_are_found(self):
+		path = [f"n{a}{b}" for (a, b) in product('abcdef', 'abcde')]
+		load(*(f"edge({a}, {b})." for (a, b) in zip(path, path[1:])), *RECURSIVE_PATHS['left'])
+		passes = 0
+		prove_variable = prolog.prove_variable
+		def counting_prove_variable(fact: Fact, depth: int):
+			nonlocal passes
+			if fact.rule.name == 'lpath': passes += 1
+			return prove_variable(fact, depth)
+
+		prolog.prove_variable = counting_prove_variable
+		try:
+			self.assertEqual(len(ask("lpath(X, Y).")), len(path) * (len(path) - 1) // 2)
+		finally:
+			prolog.prove_variable = prove_variable
+		self.assertLessEqual(passes, 2)
+
+class TestLoading(unittest.TestCase):
+	def setUp(self):
+		reset()
+
+	def facts(self, rule: str) -> set[tuple[str, ...]]:
+		return {tuple(map(str, fact.arguments)) for facts in Fact.all_facts_by_rule.get(Term.rule(rule), {}).values() for fact in facts}
+
+	def test_several_statements_on_one_line(self):
+		prolog.load_source("item(la). item(lb).item(lc).\n")
+		self.assertEqual(self.facts('item'), {('la',), ('lb',), ('lc',)})
+
+	def test_statements_spanning_lines(self):
+		prolog.load_source("item(la).\nitem(lb).\nboth(X, Y) :-\n\titem(X),\n\titem(Y).\n")
+		self.assertTrue(ask("both(la, lb)."))
+		self.assertEqual(len(Rule.all_rules_by_rule[Term.rule('both')]), 1)
+
+	def test_comments(self):
+		prolog.load_source("% items\nitem(la). % first\nboth(X, Y) :- % a rule\n\titem(X), % the first\n\titem(Y).\nitem(lb). % no newline")
+		self.assertEqual(self.facts('item'), {('la',), ('lb',)})
+		self.assertTrue(ask("both(lb, la)."))
+
+	def test_unterminated_last_statement(self):
+		with self.assertRaisesRegex(AssertionError, "period"):
+			prolog.load_source("item(la).\nitem(lb)\n")
+		self.assertEqual(self.facts('item'), {('la',)})
+
+	def test_operator_precedence(self):
+		# As in the original recursive parser, ; binds tighter than , and both are left-associative
+		for (query_str, expected) in [
+			("p(a), q(a); r(a).", "(p(a), (q(a); r(a)))"),
+			("p(a); q(a), r(a).", "((p(a); q(a)), r(a))"),
+			("p(a), q(a), r(a).", "((p(a), q(a)), r(a))"),
+			("p(a); q(a); r(a).", "((p(a); q(a)); r(a))"),
+			("(p(a), q(a)); r(a).", "((p(a), q(a)); r(a))"),
+		]:
+			with self.subTest(query_str=query_str):
+				self.assertEqual(repr(parse_query_str(query_str)), expected)
+
+	def test_rule_bodies_use_the_same_precedence(self):
+		rule = parse_statement(Lexer("p(X) :- q(X), r(X); s(X)."))
+		assert isinstance(rule, Rule)
+		self.assertEqual(repr(rule.body), "(q(X), (r(X); s(X)))")
+
+class TestLexer(unittest.TestCase):
+	def tokens(self, source: str) -> list[tuple[TokenType, str]]:
+		lexer = Lexer(source)
+		tokens = [lexer.next_token()]
+		while tokens[-1].type != TokenType.EOF: tokens.append(lexer.next_token())
+		return [(token.type, token.source) for token in tokens[:-1]]
+
+	def test_tokens(self):
+		self.assertEqual(self.tokens("foo(X, bar_baz) :- qux(X);\n\tquux(X)."), [
+			(TokenType.IDENT, 'foo'), (TokenType.LPAREN, '('), (TokenType.IDENT, 'X'), (TokenType.COMMA, ','),
+			(TokenType.IDENT, 'bar_baz'), (TokenType.RPAREN, ')'), (TokenType.COLONDASH, ':-'),
+			(TokenType.IDENT, 'qux'), (TokenType.LPAREN, '('), (TokenType.IDENT, 'X'), (TokenType.RPAREN, ')'),
+			(TokenType.SEMICOLON, ';'), (TokenType.IDENT, 'quux'), (TokenType.LPAREN, '('), (TokenType.IDENT, 'X'),
+			(TokenType.RPAREN, ')'), (TokenType.PERIOD, '.'),
+		])
+
+	def test_comments_are_skipped(self):
+		self.assertEqual(self.tokens("% leading\nfoo(a). % trailing\n% last"), self.tokens("foo(a)."))
+
+	def test_peeked_tokens_are_not_lost(self):
+		lexer = Lexer("foo(a)")
+		self.assertTrue(lexer.check_token(TokenType.IDENT))
+		self.assertEqual(lexer.expect(TokenType.IDENT).source, 'foo')
+		self.assertIsNone(lexer.take_token(TokenType.RPAREN))
+		self.assertEqual(lexer.next_token().type, TokenType.LPAREN)
+
+	def test_unknown_characters_are_rejected(self):
+		for source in ["foo :", "a - b", "1"]:
+			with self.subTest(source=source), self.assertRaisesRegex(AssertionError, "Unimplemented"):
+				self.tokens(source)
+
+	def test_non_ascii_whitespace_separates_tokens(self):
+		self.assertEqual(self.tokens("foo(a,\u00a0b).\u2003"), self.tokens("foo(a, b)."))
+
+	def test_non_ascii_letters_form_identifiers(self):
+		self.assertEqual(self.tokens("café(été, 中文)")[::2],
+			[(TokenType.IDENT, 'café'), (TokenType.IDENT, 'été'), (TokenType.IDENT, '中文')])
+
+	def test_other_non_ascii_characters_are_rejected(self):
+		for source in ["a—b", "a → b", "\U0001f600"]:
+			with self.subTest(source=source), self.assertRaisesRegex(AssertionError, "Unimplemented"):
+				self.tokens(source)
+
+if __name__ == '__main__': unittest.main()